@@ -1,13 +1,18 @@
 # double_calendar_monitor.py
 
 import streamlit as st
-import pandas as pd
 import requests
-from datetime import datetime, timedelta
-import json
-import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import date, datetime, timedelta, time as dt_time
+from zoneinfo import ZoneInfo
 import asyncio
+import threading
+from functools import lru_cache
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 import telegram
+from streamlit_autorefresh import st_autorefresh
 from supabase import create_client, Client
 
 # ==============================================================================
@@ -25,16 +30,33 @@ st.markdown("""
     </style>
     """, unsafe_allow_html=True)
 
-MARKET_DATA_TOKEN = st.secrets.get("MARKET_DATA_TOKEN", "")
-BOT_TOKEN = st.secrets.get("telegram", {}).get("BOT_TOKEN", "")
-CHAT_ID = st.secrets.get("telegram", {}).get("CHAT_ID", "")
 API_BASE_URL = "https://api.marketdata.app/v1/"
 REFRESH_INTERVAL_SECONDS = 300 
+QUOTE_FETCH_WORKERS = 16
+MARKET_TZ = ZoneInfo("America/New_York")  # MarketData cota opções listadas nos EUA
+HISTORY_MAX_SAMPLES = 288  # ~3,7 pregões (09:30-16:00 NY) de amostras a cada 5 min
+_DIGIT_STRIP = str.maketrans('', '', '0123456789')
+_ALERT_TMPL = "🎯 *ALERTA DE LUCRO ({cal_type})* 🎯\n\n*Ativo:* `{ticker}`\n*Calendário:* {cal_type} Strike {strike:.2f}\n*Lucro Atual:* `{z:.2f}%`\n*Meta:* `{target:.2f}%`"
+
+# Timer no navegador dispara o rerun; o worker não fica preso em sleep entre atualizações
+st_autorefresh(interval=REFRESH_INTERVAL_SECONDS * 1000, key="auto_refresh")
+
+@st.cache_resource
+def get_config():
+    # Segredos lidos uma única vez por processo, não a cada rerun
+    telegram_secrets = st.secrets.get("telegram", {})
+    return SimpleNamespace(
+        market_data_token=st.secrets.get("MARKET_DATA_TOKEN", ""),
+        bot_token=telegram_secrets.get("BOT_TOKEN", ""),
+        chat_id=telegram_secrets.get("CHAT_ID", ""),
+    )
+
+@st.cache_resource
+def get_supabase_client() -> Client:
+    return create_client(st.secrets["supabase"]["url"], st.secrets["supabase"]["key"])
 
 try:
-    supabase_url = st.secrets["supabase"]["url"]
-    supabase_key = st.secrets["supabase"]["key"]
-    supabase: Client = create_client(supabase_url, supabase_key)
+    supabase: Client = get_supabase_client()
 except Exception as e:
     st.error(f"Erro ao conectar com o Supabase. Verifique os 'Secrets'. Detalhes: {e}")
     st.stop()
@@ -42,10 +64,21 @@ except Exception as e:
 # ==============================================================================
 # FUNÇÕES DE BANCO DE DADOS
 # ==============================================================================
+def trim_position_history(position_data):
+    # Posições gravadas antes do limite de histórico podem trazer séries maiores que HISTORY_MAX_SAMPLES
+    for series_by_key in position_data.get('history', {}).values():
+        for series in series_by_key.values():
+            del series[:-HISTORY_MAX_SAMPLES]
+    return position_data
+
+@st.cache_data(ttl=REFRESH_INTERVAL_SECONDS)
+def fetch_position_rows():
+    # Fora do try de load_positions_from_db para que falhas não fiquem em cache; as escritas limpam o cache
+    return supabase.table('positions').select('ticker, position_data').execute().data
+
 def load_positions_from_db():
     try:
-        response = supabase.table('positions').select('ticker, position_data').execute()
-        return {item['ticker']: item['position_data'] for item in response.data}
+        return {item['ticker']: trim_position_history(item['position_data']) for item in fetch_position_rows()}
     except Exception as e:
         st.error(f"Erro ao carregar posições do DB: {e}")
         return {}
@@ -53,40 +86,97 @@ def load_positions_from_db():
 def add_position_to_db(ticker, position_data):
     try:
         supabase.table('positions').insert({"ticker": ticker, "position_data": position_data}).execute()
+        fetch_position_rows.clear()
+        return True
     except Exception as e:
         st.error(f"Erro ao adicionar posição no DB: {e}")
+        return False
 
 def update_position_in_db(ticker, position_data):
     try:
         supabase.table('positions').update({"position_data": position_data}).eq('ticker', ticker).execute()
+        fetch_position_rows.clear()
+        return True
     except Exception as e:
         st.error(f"Erro ao atualizar posição no DB: {e}")
+        return False
+
+def flush_dirty_positions(positions_by_ticker):
+    # UPDATE por ticker, sem upsert: uma posição excluída em outra sessão não é recriada e nada depende de constraints do schema
+    if not positions_by_ticker: return True
+    success = True
+    for ticker, position_data in positions_by_ticker.items():
+        try:
+            supabase.table('positions').update({"position_data": position_data}).eq('ticker', ticker).execute()
+        except Exception as e:
+            st.error(f"Erro ao atualizar posição {ticker} no DB: {e}")
+            success = False
+    fetch_position_rows.clear()
+    return success
 
 def delete_position_from_db(ticker):
     try:
         supabase.table('positions').delete().eq('ticker', ticker).execute()
+        fetch_position_rows.clear()
+        return True
     except Exception as e:
         st.error(f"Erro ao deletar posição no DB: {e}")
+        return False
 
 # ==============================================================================
 # FUNÇÕES DE API E CÁLCULOS
 # ==============================================================================
-def send_telegram_message(message):
-    async def send():
-        try:
-            bot = telegram.Bot(token=BOT_TOKEN)
-            await bot.send_message(chat_id=CHAT_ID, text=message, parse_mode='Markdown')
-        except Exception as e: st.error(f"Falha ao enviar Telegram: {e}")
-    try: asyncio.run(send())
-    except RuntimeError: asyncio.get_running_loop().create_task(send())
+@st.cache_resource
+def get_telegram_bot():
+    return telegram.Bot(token=get_config().bot_token)
+
+@st.cache_resource
+def get_telegram_loop():
+    # O cliente HTTP do Bot fica preso ao loop onde foi usado; um loop persistente (com lock entre sessões) permite reaproveitá-lo
+    return asyncio.new_event_loop(), threading.Lock()
+
+def queue_telegram_message(message):
+    # A fila fica no session_state para não perder alertas se o rerun for interrompido antes do envio
+    st.session_state.setdefault('telegram_queue', []).append(message)
+
+def flush_telegram_queue():
+    messages = st.session_state.get('telegram_queue', [])
+    if not messages: return
+    config = get_config()
+    # Telegram é opcional: sem token ou chat configurado os alertas são descartados
+    if not config.bot_token or not config.chat_id:
+        messages.clear()
+        return
+    try:
+        bot = get_telegram_bot()
+        async def send_all():
+            # Envio sequencial: o pool HTTP padrão do Bot (python-telegram-bot < 22) tem uma única conexão
+            results = []
+            for message in messages:
+                try: results.append(await bot.send_message(chat_id=config.chat_id, text=message, parse_mode='Markdown'))
+                except Exception as e: results.append(e)
+            return results
+        loop, lock = get_telegram_loop()
+        with lock: results = loop.run_until_complete(send_all())
+    except Exception as e: results = [e]
+    for result in results:
+        if isinstance(result, Exception): st.error(f"Falha ao enviar Telegram: {result}")
+    messages.clear()
+
+@st.cache_resource
+def get_http_session():
+    # Sessão compartilhada: reaproveita conexões TCP/TLS com a API entre chamadas e reruns
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=2, read=0, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=False, raise_on_status=False)))
+    session.headers.update({"Accept": "application/json", "Authorization": f"Bearer {get_config().market_data_token}"})
+    return session
 
-@st.cache_data(ttl=REFRESH_INTERVAL_SECONDS - 10)
+@st.cache_data(ttl=REFRESH_INTERVAL_SECONDS - 10, max_entries=256, show_spinner=False)
 def get_option_data(option_symbol):
-    if not MARKET_DATA_TOKEN or not option_symbol: return (False, "Token ou símbolo ausente.")
+    if not get_config().market_data_token or not option_symbol: return (False, "Token ou símbolo ausente.")
     url = f"{API_BASE_URL}options/quotes/{option_symbol}/"
-    params = {'token': MARKET_DATA_TOKEN}
     try:
-        r = requests.get(url, params=params, headers={"Accept": "application/json"}, timeout=10)
+        r = get_http_session().get(url, timeout=10)
         r.raise_for_status()
         data = r.json()
         if data.get('s') == 'ok': return (True, data)
@@ -99,12 +189,44 @@ def get_option_data(option_symbol):
     except requests.exceptions.RequestException as e:
         return (False, f"Erro de conexão para {option_symbol}: {e}")
 
+def is_market_open(now=None):
+    now = now or datetime.now(MARKET_TZ)
+    return now.weekday() < 5 and dt_time(9, 30) <= now.time() <= dt_time(16, 0)
+
+def get_option_quotes(symbols):
+    # Busca todas as cotações do ciclo de uma vez, em paralelo, antes da renderização
+    with ThreadPoolExecutor(max_workers=QUOTE_FETCH_WORKERS) as executor:
+        return dict(zip(symbols, executor.map(get_option_data, symbols)))
+
+@lru_cache(maxsize=1024)
+def parse_iso_date(date_str):
+    # Datas são gravadas como YYYY-MM-DD e se repetem a cada rerun
+    return date.fromisoformat(date_str)
+
+@lru_cache(maxsize=1024)
 def generate_option_symbol(ticker, exp_date, strike, option_type):
-    exp_dt = datetime.strptime(exp_date, "%Y-%m-%d")
+    exp_dt = parse_iso_date(exp_date)
     strike_part = f"{int(strike * 1000):08d}"
-    base_ticker = ''.join([i for i in ticker if not i.isdigit()])
+    base_ticker = ticker.translate(_DIGIT_STRIP)
     return f"{base_ticker}{exp_dt.strftime('%y%m%d')}{option_type[0].upper()}{strike_part}"
 
+def get_calendar_symbols(ticker, cal_data):
+    front_symbol = generate_option_symbol(ticker, cal_data['expirations']['front'], cal_data['strike_front'], cal_data['type'])
+    back_symbol = generate_option_symbol(ticker, cal_data['expirations']['back'], cal_data['strike_back'], cal_data['type'])
+    return front_symbol, back_symbol
+
+def get_all_calendars(data):
+    return [data['put_original'], data['call_original']] + data.get('adjustments', [])
+
+def append_history_sample(history, ts, **sample):
+    # Uma amostra por minuto; descarta as mais antigas para o histórico (e o blob salvo no DB) não crescer sem limite
+    if history['ts'] and history['ts'][-1] == ts: return False
+    for key, value in {"ts": ts, **sample}.items():
+        series = history[key]
+        series.append(value)
+        del series[:-HISTORY_MAX_SAMPLES]
+    return True
+
 def calculate_pl_values(td_price_back, td_price_front, now_price_back, now_price_front):
     if now_price_back is None or now_price_front is None:
         return {"initial_cost": None, "absolute_pl": None, "z_percent": None}
@@ -119,38 +241,35 @@ def calculate_pl_values(td_price_back, td_price_front, now_price_back, now_price
 # FUNÇÃO DE RENDERIZAÇÃO
 # ==============================================================================
 def render_calendar_block(ticker, calendar_data, live_data, calendar_history):
-    st.subheader(f"Calendário {calendar_data['display_name']}")
+    display_name = calendar_data['display_name']
+    cal_type_upper = calendar_data['type'].upper()
+    alert_target = calendar_data.get('alert_target', 0)
+    ts, zs = calendar_history['ts'], calendar_history['z']
+    st.subheader(f"Calendário {display_name}")
     
     z_percent_val = live_data['z_percent']
     
-    if z_percent_val is not None:
-        current_time_str = datetime.now().strftime("%H:%M")
-        if not calendar_history['ts'] or calendar_history['ts'][-1] != current_time_str:
-            calendar_history['ts'].append(current_time_str)
-            calendar_history['z'].append(z_percent_val)
-    
-    if z_percent_val is not None and calendar_data.get('alert_target', 0) > 0:
-        if z_percent_val >= calendar_data['alert_target'] and not calendar_data.get('alert_sent', False):
-            cal_type = calendar_data['type'].upper()
-            msg = f"🎯 *ALERTA DE LUCRO ({cal_type})* 🎯\n\n*Ativo:* `{ticker}`\n*Calendário:* {cal_type} Strike {calendar_data['strike_front']:.2f}\n*Lucro Atual:* `{z_percent_val:.2f}%`\n*Meta:* `{calendar_data['alert_target']:.2f}%`"
-            send_telegram_message(msg)
-            calendar_data['alert_sent'] = True
-        elif z_percent_val < calendar_data['alert_target'] and calendar_data.get('alert_sent', False):
-            calendar_data['alert_sent'] = False
+    # Só altera alert_sent (e marca a posição para gravação) quando o estado do alerta de fato muda
+    prev_alert_sent = calendar_data.get('alert_sent', False)
+    alert_sent = z_percent_val >= alert_target if z_percent_val is not None and alert_target > 0 else prev_alert_sent
+    if alert_sent != prev_alert_sent:
+        calendar_data['alert_sent'] = alert_sent
+        st.session_state.dirty_tickers.add(ticker)
+        if alert_sent:
+            queue_telegram_message(_ALERT_TMPL.format(cal_type=cal_type_upper, ticker=ticker, strike=calendar_data['strike_front'], z=z_percent_val, target=alert_target))
             
     col1, col2 = st.columns(2)
-    cal_type_upper = calendar_data['type'].upper()
     price_front_display = f"{live_data['now_price_front']:.2f}" if live_data['now_price_front'] is not None else "---"
     price_back_display = f"{live_data['now_price_back']:.2f}" if live_data['now_price_back'] is not None else "---"
     z_percent_display = f"{z_percent_val:.2f}%" if z_percent_val is not None else "---"
 
     col1.metric(f"{cal_type_upper}F Now", price_front_display, f"↑ TD: {calendar_data['td_price_front']:.2f}")
     col2.metric(f"{cal_type_upper}B Now", price_back_display, f"↑ TD: {calendar_data['td_price_back']:.2f}")
-    st.metric(f"%Z (Alvo: {calendar_data.get('alert_target', 0)}%)", z_percent_display)
+    st.metric(f"%Z (Alvo: {alert_target}%)", z_percent_display)
     
-    if len(calendar_history['z']) > 1:
-        chart_data = pd.DataFrame({f"%Z {calendar_data['display_name']}": calendar_history['z']}, index=calendar_history['ts'])
-        st.line_chart(chart_data)
+    if len(zs) > 1:
+        z_label = f"%Z {display_name}"
+        st.line_chart({"Hora": ts, z_label: zs}, x="Hora", y=z_label)
 
     st.divider()
 
@@ -161,6 +280,8 @@ st.title("🗓️ Monitoramento de Calendários Duplos Pré-Earnings")
 
 if 'positions' not in st.session_state:
     st.session_state.positions = load_positions_from_db()
+if 'dirty_tickers' not in st.session_state:
+    st.session_state.dirty_tickers = set()
 
 with st.sidebar:
     st.header("Adicionar Nova Posição")
@@ -202,25 +323,39 @@ with st.sidebar:
                 "history": {"put_original": {"ts": [], "z": []}, "call_original": {"ts": [], "z": []}, "back_vol": {"ts": [], "vol": []}}, 
                 "adjustments": []
             }
-            add_position_to_db(ticker, new_pos_data)
-            st.session_state.positions = load_positions_from_db()
+            # Reflete a escrita localmente em vez de recarregar todas as posições do DB
+            if add_position_to_db(ticker, new_pos_data): st.session_state.positions[ticker] = new_pos_data
             st.success(f"Posição em {ticker} adicionada ao banco de dados!")
             st.rerun()
 
 if not st.session_state.positions:
     st.info("Nenhuma posição monitorada. Adicione uma na barra lateral.")
 else:
+    # Data no rótulo: o histórico cobre vários pregões e o formato ISO ordena cronologicamente no eixo x
+    current_time_str = datetime.now(MARKET_TZ).strftime("%Y-%m-%d %H:%M")
+    # dict.fromkeys remove símbolos repetidos (ajustes que compartilham pernas) mantendo a ordem
+    all_symbols = list(dict.fromkeys(symbol for ticker, data in st.session_state.positions.items() for cal_data in get_all_calendars(data) for symbol in get_calendar_symbols(ticker, cal_data)))
+    # Com o mercado fechado as cotações não mudam: reaproveita a última obtida e só busca o que ainda não tem cotação válida
+    market_open = is_market_open()
+    last_quotes = st.session_state.get('last_quotes', {})
+    symbols_to_fetch = [symbol for symbol in all_symbols if market_open or not last_quotes.get(symbol, (False, None))[0]]
+    fetched_quotes = get_option_quotes(symbols_to_fetch)
+    # Erros de cotação são avisados aqui, na fase de busca, e só quando o símbolo passa a falhar (não a cada rerun)
+    new_failures = [result for symbol, (success, result) in fetched_quotes.items() if not success and last_quotes.get(symbol, (True, None))[0]]
+    if new_failures: st.toast(new_failures[0] if len(new_failures) == 1 else f"{len(new_failures)} cotações indisponíveis. Ex.: {new_failures[0]}", icon="⚠️")
+    quotes = {**last_quotes, **fetched_quotes}
+    st.session_state.last_quotes = quotes = {symbol: quotes[symbol] for symbol in all_symbols}
+    if not market_open: st.caption("Mercado fechado — exibindo última cotação")
+    
     for ticker, data in list(st.session_state.positions.items()):
         with st.expander(f"Ativo: {ticker}", expanded=True):
-            all_calendars = [data['put_original'], data['call_original']] + data.get('adjustments', [])
+            all_calendars = get_all_calendars(data)
             live_data_list = []
             
             for cal_data in all_calendars:
-                # ALTERADO: Passa o strike correto (front/back) para a função
-                front_symbol = generate_option_symbol(ticker, cal_data['expirations']['front'], cal_data['strike_front'], cal_data['type'])
-                back_symbol = generate_option_symbol(ticker, cal_data['expirations']['back'], cal_data['strike_back'], cal_data['type'])
-                success_front, front_api_data = get_option_data(front_symbol)
-                success_back, back_api_data = get_option_data(back_symbol)
+                front_symbol, back_symbol = get_calendar_symbols(ticker, cal_data)
+                success_front, front_api_data = quotes[front_symbol]
+                success_back, back_api_data = quotes[back_symbol]
                 price_front_val = front_api_data['last'][0] if success_front and front_api_data.get('last') else 0
                 now_price_front = price_front_val if price_front_val > 0 else None
                 price_back_val = back_api_data['last'][0] if success_back and back_api_data.get('last') else 0
@@ -228,6 +363,13 @@ else:
                 pl_info = calculate_pl_values(cal_data['td_price_back'], cal_data['td_price_front'], now_price_back, now_price_front)
                 live_data_list.append({"now_price_front": now_price_front, "now_price_back": now_price_back, "back_api_data": back_api_data if success_back else None, **pl_info})
             
+            history_keys = ['put_original', 'call_original'] + [f"adj_{i}" for i in range(len(data.get('adjustments', [])))]
+            for history_key, live_data in zip(history_keys, live_data_list):
+                calendar_history = data['history'].setdefault(history_key, {"ts": [], "z": []})
+                # Com o mercado fechado a cotação é repetida; não grava amostras duplicadas no histórico
+                if market_open and live_data['z_percent'] is not None and append_history_sample(calendar_history, current_time_str, z=live_data['z_percent']):
+                    st.session_state.dirty_tickers.add(ticker)
+            
             col1, col2 = st.columns(2)
             with col1:
                 render_calendar_block(ticker, data['put_original'], live_data_list[0], data['history']['put_original'])
@@ -236,7 +378,6 @@ else:
             
             for i, adj_data in enumerate(data.get('adjustments', [])):
                 adj_history_key = f"adj_{i}"
-                if adj_history_key not in data['history']: data['history'][adj_history_key] = {"ts": [], "z": []}
                 if i % 2 == 0:
                     col1, col2 = st.columns(2)
                     with col1:
@@ -265,27 +406,22 @@ else:
             back_vol_now = ((back_vol_now_p + back_vol_now_c) / 2) if back_vol_now_p or back_vol_now_c else 0
             
             vol_history = data['history']['back_vol']
-            if back_vol_now > 0:
-                current_time_str = datetime.now().strftime("%H:%M")
-                if not vol_history['ts'] or vol_history['ts'][-1] != current_time_str:
-                    vol_history['ts'].append(current_time_str)
-                    vol_history['vol'].append(back_vol_now)
+            if market_open and back_vol_now > 0 and append_history_sample(vol_history, current_time_str, vol=back_vol_now):
+                st.session_state.dirty_tickers.add(ticker)
             
             td_vol = data.get("td_back_vol", 0)
             vol_display = f"{back_vol_now:.2f}%" if back_vol_now > 0 else "---"
             st.metric("Vol Média Atual (Back)", vol_display, f"↑ TD: {td_vol:.2f}%")
             if len(vol_history['vol']) > 1:
-                chart_data_v = pd.DataFrame({'Back Vol': vol_history['vol']}, index=vol_history['ts'])
-                st.line_chart(chart_data_v)
+                st.line_chart({"Hora": vol_history['ts'], 'Back Vol': vol_history['vol']}, x="Hora", y='Back Vol')
             
-            fad_dt = datetime.strptime(data['fad_date'], "%Y-%m-%d").date()
+            fad_dt = parse_iso_date(data['fad_date'])
             dias_para_fad = (fad_dt - datetime.now().date()).days
             st.info(f"**FAD (Final Adjustment Date):** {fad_dt.strftime('%d/%m/%Y')} (Faltam {dias_para_fad} dias)")
             
             if st.button("➕ Adicionar Ajuste", key=f"add_adj_{ticker}"): st.session_state.adjusting_ticker = ticker; st.rerun()
             if st.button("❌ Excluir Posição", key=f"del_{ticker}"):
-                delete_position_from_db(ticker)
-                st.session_state.positions = load_positions_from_db()
+                if delete_position_from_db(ticker): del st.session_state.positions[ticker]
                 if 'adjusting_ticker' in st.session_state: del st.session_state.adjusting_ticker
                 st.rerun()
 
@@ -319,16 +455,18 @@ if 'adjusting_ticker' in st.session_state:
                 "expirations": adj_exp_str
             }
             position_to_update.setdefault('adjustments', []).append(new_adj)
-            update_position_in_db(ticker_to_adjust, position_to_update)
-            st.session_state.positions = load_positions_from_db()
+            # position_to_update já é o estado novo; só recarrega do DB se a escrita falhar
+            if not update_position_in_db(ticker_to_adjust, position_to_update): st.session_state.positions = load_positions_from_db()
             del st.session_state.adjusting_ticker
             st.rerun()
 
     if st.button("Cancelar Ajuste"): del st.session_state.adjusting_ticker; st.rerun()
 
-for ticker, data in st.session_state.positions.items():
-    update_position_in_db(ticker, data)
+flush_telegram_queue()
+
+# Só persiste as posições cujo histórico ou estado de alerta mudou neste rerun
+# Se a escrita falhar, mantém os tickers marcados para tentar de novo no próximo rerun
+if flush_dirty_positions({ticker: st.session_state.positions[ticker] for ticker in st.session_state.dirty_tickers if ticker in st.session_state.positions}):
+    st.session_state.dirty_tickers.clear()
 
 st.caption(f"Última atualização: {datetime.now().strftime('%H:%M:%S')}")
-time.sleep(REFRESH_INTERVAL_SECONDS)
-st.rerun()